@@ -0,0 +1,72 @@
+#################################################  DESCRIPTION  ########################################################
+# Name: common.py
+#
+# Description:  Functions shared by the Traversals and Detours workflows.
+#
+# Requirements: Network Analyst Extension
+########################################################################################################################
+
+import arcpy, hashlib, os
+import numpy
+
+########################################################################################################################
+
+
+def frequencyTable(arr, outPath, caseField, freqField, sumFields):
+    # Count rows and sum fields for each unique value of the case field in a NumPy array (in place of
+    # Frequency_analysis). sumFields maps each summed array field to its field name in the output table
+    keys, inverse, counts = numpy.unique(arr[caseField], return_inverse=True, return_counts=True)
+    freqArr = numpy.empty(len(keys), [(caseField, keys.dtype), (freqField, numpy.int32)] +
+                          [(name, numpy.float64) for name in sumFields.values()])
+    freqArr[caseField] = keys
+    freqArr[freqField] = counts
+    for field, name in sumFields.items():
+        freqArr[name] = numpy.bincount(inverse, weights=arr[field], minlength=len(keys))
+
+    # NumPyArrayToTable won't overwrite an existing table
+    if arcpy.Exists(outPath):
+        arcpy.Delete_management(outPath)
+    arcpy.da.NumPyArrayToTable(freqArr, outPath)
+
+
+def gdbCacheKey(gdbPath):
+    # Key a GDB copy on the name, size, and modification time of every file in the input GDB (other than lock files), so
+    # a copy made from an unchanged input can be reused when the script is re-run
+    sha = hashlib.sha1()
+    for name in sorted(os.listdir(gdbPath)):
+        if name.endswith(".lock"):
+            continue
+        stat = os.stat(os.path.join(gdbPath, name))
+        sha.update("{0}:{1}:{2};".format(name, stat.st_size, stat.st_mtime_ns).encode())
+    return sha.hexdigest()[:12]
+
+
+def copyGDB(inputGDB, outGDB):
+    # Copy the input GDB, unless outGDB is already a copy of the same (unchanged) input; the cache key is written inside
+    # the copy so it is deleted along with it
+    cacheKey = gdbCacheKey(inputGDB)
+    cacheKeyFile = os.path.join(outGDB, ".cache_key")
+    if os.path.exists(cacheKeyFile):
+        with open(cacheKeyFile) as f:
+            if f.read() == cacheKey:
+                print("\tReusing GDB Copy from previous run of the same input")
+                return
+    if arcpy.Exists(outGDB):
+        arcpy.Delete_management(outGDB)
+    arcpy.Copy_management(inputGDB, outGDB)
+    with open(cacheKeyFile, "w") as f:
+        f.write(cacheKey)
+
+
+def poolSize(maxWorkers=None):
+    # Number of worker processes for a pool: one per core (or maxWorkers, if lower), but never more than 61, since
+    # ProcessPoolExecutor and multiprocessing.Pool fail on Windows above that many processes
+    return min(61, os.cpu_count(), maxWorkers or os.cpu_count())
+
+
+def initWorkspace(gdbPath):
+    # Each worker process needs its own Network Analyst license and workspace
+    arcpy.CheckOutExtension("Network")
+    arcpy.env.workspace = gdbPath
+    arcpy.env.scratchWorkspace = "memory"
+    arcpy.env.overwriteOutput = True
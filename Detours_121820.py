@@ -24,12 +24,10 @@
 ########################################################################################################################
 
 import arcpy, datetime, os, sys
-
-# Check out the Network Analyst extension license
-arcpy.CheckOutExtension("Network")
-
-# Set start time for code
-print("Starting Workflow at time: {0}".format(datetime.datetime.now().strftime("%H:%M:%S")))
+from collections import defaultdict
+import numpy
+from Common_121820 import copyGDB, frequencyTable, initWorkspace, poolSize
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 ########################################### MODEL INPUTS & SETTINGS ####################################################
 
@@ -49,172 +47,243 @@ businesses = r"businesses"
 bridges = r"Weight_Restricted_Bridges"
 
 brdgNoField = "BRDG_NBR"
+# Set field flagging business-bridge pairs that have been solved (with or without a detour), so re-runs skip them
+solvedField = "Detour_Solved"
 snappables = ["Network_LocalStreets"]
 
+# Set maximum number of worker processes used to solve business-bridge detours in parallel (capped at the number of
+# cores and at 61 on Windows); each worker holds a full Closest Facility layer in memory, so lower this if RAM runs out
+maxWorkers = 16
+
+# Set number of solved business-bridge pairs to collect before writing them to the detour table (limits the solves lost
+# if a run is interrupted)
+writeBatchSize = 1000
+
+# Select whether or not to also write all detour tables merged into a single feature class (Detours_Merged)
+mergeDetours = False
+
 ########################################################################################################################
 
-# Create GDB Copy
-print("Creating GDB Copy for Output")
-start = datetime.datetime.now()
-gdbCopy = os.path.splitext(os.path.basename(inputGDB))[0] + outExt + ".gdb"
-arcpy.Copy_management(inputGDB, wd + '\\' + gdbCopy)
-print("\tFinished after {0}".format(str(datetime.datetime.now()-start)))
-
-# Set Workspace to GDB Copy
-arcpy.env.workspace = wd + '\\' + gdbCopy
-arcpy.env.overwriteOutput = True
-
-# Count number of detours to process
-setList = arcpy.ListFeatureClasses("Bridges_by_Bus_*")
-totalRows = 0
-for s in setList:
-    count = int(arcpy.GetCount_management(arcpy.env.workspace + "//" + s).getOutput(0))
-    totalRows += count
-print("Total Rows to Process: {0}".format(totalRows))
-
-# Iterate through list of bridge tables
-dests = arcpy.ListFeatureClasses(feature_dataset=destinations)
-print(dests)
-
-# Set iterating variables
-x=0
-startRow = datetime.datetime.now()
-
-# Loop through bridge tables and calculate detours for each bridge-business pair
-for dest in dests:
-    print("Initiating Workflow for Destination: {0}\tat {1}".format(dest, datetime.datetime.now().strftime("%H:%M:%S")))
-    # Set up Closest Facility Tool
-    outNALayerName = dest + "_" + "CF"
-    impedanceAttribute = "Length"
-    inFacilities = destinations + "/" + dest
-
-    # Copy bridge table from traversal step and setup new detour time field
-    bridgeTable = arcpy.env.workspace + '\\' + "Bridges_by_Bus_{0}".format(dest)
-    arcpy.Copy_management(bridgeTable, arcpy.env.workspace + '\\' + "detours_{0}".format(dest))
-    detours = "detours_{0}".format(dest)
-    newField = "No_Bridge_Time"
-    arcpy.AddField_management(detours, newField, "DOUBLE")
-
-    # Populate dictionary with bridges and the businesses that traverse them (used to determine bridge to remove)
-    busDict = {}
-    with arcpy.da.SearchCursor(detours, ["Business_ID", brdgNoField]) as sc:
-        for row in sc:
-            if row[0] not in busDict:
-                busDict[row[0]] = [row[1]]
-            else:
-                busDict[row[0]].append(row[1])
-
-    # Through businesses in dictionary, creating a feature layer for each to as facility
-    for detourBusID in busDict:
-        for removeBridgeNum in busDict[detourBusID]:
-            # Create Feature Layer for each business
-            arcpy.MakeFeatureLayer_management(businesses, "businessDetour", "OBJECTID = {0}".format(int(detourBusID)))
-            inIncidents = "businessDetour"
-
-            # Create Feature Layer for each bridge
-            arcpy.MakeFeatureLayer_management(bridges, "removeBridge",
-                                             "BRDG_NBR = '{0}'".format(removeBridgeNum))
-
-            # Define barriers in Closest Facility as bridge
-            barrier = "removeBridge"
-
-            # Create a new closest facility analysis layer.
-            outNALayer = arcpy.na.MakeClosestFacilityLayer(inNetworkDataset, outNALayerName, impedanceAttribute)
-
-            # Get the layer object from the result object. The closest facility layer can
-            # now be referenced using the layer object.
-            outNALayer = outNALayer.getOutput(0)
-
-            # Get the names of all the sublayers within the closest facility layer.
-            subLayerNames = arcpy.na.GetNAClassNames(outNALayer)
-            # Stores the layer names that we will use later
-            facilitiesLayerName = subLayerNames["Facilities"]
-            incidentsLayerName = subLayerNames["Incidents"]
-
-            # Set valid snapping features from all features in network dataset
-            descNet = arcpy.Describe(inNetworkDataset)
-            sourceNames = [[i.name] for i in descNet.sources]
-            for i in sourceNames:
-                if i[0] in snappables:
-                    i.append("SHAPE")
-                else:
-                    i.append("NONE")
-            print("Source Names:", sourceNames)
-
-            # Load Locations for Facilities, Incidents, and Barriers
-            arcpy.na.AddLocations(outNALayer, facilitiesLayerName, inFacilities)
-            arcpy.na.AddLocations(outNALayer, incidentsLayerName, inIncidents, '#', '#', '#', sourceNames)
-            arcpy.na.AddLocations(outNALayer, "Point Barriers", barrier, '#', '#', '#', '#', '#', '#', "SNAP")
-
-            # Solve the Closest Facility layer
-            arcpy.na.Solve(outNALayer, "#", "CONTINUE")
-
-            # Get detour time from route results; set detour time to None if not found
-            try:
-                z = max([int(i[15:]) for i in arcpy.ListDatasets("ClosestFacility*", "Feature")])
-                routes = arcpy.env.workspace + "/" + "ClosestFacility{0}/CFRoutes{0}".format(z)
-                routeRow = []
-                with arcpy.da.SearchCursor(routes, ["IncidentID", "Total_Length", "SHAPE@"]) as sc2:
-                    try:
-                        routeRow = sc2.next()
-                    except StopIteration:
-                        routeRow = [detourBusID, None, None]
-                key = "{0},{1}".format(detourBusID,removeBridgeNum)
-            except:
-                routeRow = [detourBusID, None, None]
-
-            # Add detour time to detour table
-            with arcpy.da.UpdateCursor(detours, ["Business_ID", brdgNoField, "No_Bridge_Time", "SHAPE@"]) as uc:
-                for detoursRow in uc:
-                    detKey = "{0},{1}".format(detoursRow[0],detoursRow[1])
-                    if detKey == key:
-                        detoursRow[2] = routeRow[1]
-                        detoursRow[3] = routeRow[2]
-                        uc.updateRow(detoursRow)
-
-            # Get number for name of most recent Closest Facility Solution and delete it
-            arcpy.Delete_management("ClosestFacility{0}".format(z))
-            x+=1
-            totalRows-=1
-            endRow = datetime.datetime.now()
-
-            # Print time statistics
-            avgTime = (endRow-startRow)/x
-            print("\tCompleted:\t{0}\n\tAvg. Time per Row:{1}\n\tRemaining Rows:{2}".format(x,avgTime,totalRows))
-            print(datetime.datetime.now())
-
-    # Calculate detour metrics in detours table
-    detTime = "DET_TIME"
-    arcpy.AddField_management(detours, detTime, "DOUBLE")
-    subtractExp = "!No_Bridge_Time!-!Base_Length!"
-    arcpy.CalculateField_management(detours, detTime, subtractExp, "PYTHON3")
-
-    jobDetTime = "JOB_DET_TIME"
-    arcpy.AddField_management(detours, jobDetTime, "DOUBLE")
-    multExp = "!DET_TIME!*!Truck_Int!"
-    arcpy.CalculateField_management(detours, jobDetTime, multExp, "PYTHON3")
-
-    distWghtDetTime = "DISTW_JOB_DET_TIME"
-    arcpy.AddField_management(detours, distWghtDetTime, "DOUBLE")
-    multExp = "!DET_TIME!*!Truck_Int_DW!"
-    arcpy.CalculateField_management(detours, distWghtDetTime, multExp, "PYTHON3")
-
-# Merge all detour tables into single table
-mergeDetours = arcpy.ListFeatureClasses("detours_*")
-arcpy.Merge_management(mergeDetours, arcpy.env.workspace + '\\' + "Detours_Merged")
-
-# Calculate summary of detour statistics by bridge and rename fields
-arcpy.Frequency_analysis("Detours_Merged", "Detours_by_Bridge", brdgNoField, [detTime, jobDetTime, distWghtDetTime])
-detSum = "DET_TIME_SUM"
-arcpy.AlterField_management("Detours_by_Bridge", detTime, detSum, detSum)
-jobDetSum = "JOB_DET_TIME_SUM"
-arcpy.AlterField_management("Detours_by_Bridge", jobDetTime, jobDetSum, jobDetSum)
-distWDetTimeSum = "DISTW_JOB_DET_TIME_SUM"
-arcpy.AlterField_management("Detours_by_Bridge", distWghtDetTime, distWDetTimeSum, distWDetTimeSum)
-
-# Join bridge metrics from detour table to bridges
-arcpy.JoinField_management(bridges, brdgNoField, "Detours_by_Bridge", brdgNoField, [detSum, jobDetSum, distWDetTimeSum])
-
-# Calc and print end time.
-endingTime = datetime.datetime.now()
-print(endingTime)
+
+# Closest Facility layers built by this worker process, keyed by destination feature class
+cfLayers = {}
+
+
+def initWorker(gdbPath):
+    initWorkspace(gdbPath)
+
+    # Create Feature Layers for businesses (incidents) and bridges (barriers) once; solves only change the selection
+    arcpy.MakeFeatureLayer_management(businesses, "businessDetour")
+    arcpy.MakeFeatureLayer_management(bridges, "removeBridge")
+
+
+def getCFLayer(network, destFC):
+    # Build the closest facility layer for a destination once per worker; only incidents and barriers change per solve
+    if destFC not in cfLayers:
+        # Create a new closest facility analysis layer and get the layer object from the result object. The layer's
+        # data is stored in the memory workspace so solves don't create and delete feature datasets in the GDB
+        outNALayerName = os.path.basename(destFC) + "_" + "CF"
+        networkPath = os.path.join(arcpy.env.workspace, network)
+        with arcpy.EnvManager(workspace="memory"):
+            outNALayer = arcpy.na.MakeClosestFacilityLayer(networkPath, outNALayerName, "Length").getOutput(0)
+
+        # Get the names of all the sublayers within the closest facility layer
+        subLayerNames = arcpy.na.GetNAClassNames(outNALayer)
+
+        # Load Facilities, which are the same for every business-bridge pair
+        arcpy.na.AddLocations(outNALayer, subLayerNames["Facilities"], destFC)
+
+        # Map Barriers to the network location fields calculated on bridges so they're loaded without a location search
+        barrierMappings = arcpy.na.NAClassFieldMappings(outNALayer, subLayerNames["Barriers"], True)
+
+        # Keep the routes sublayer so solved detours are read straight from the layer, along with the destination's
+        # spatial reference, which detour shapes are written in
+        routes = outNALayer.listLayers(subLayerNames["CFRoutes"])[0]
+        destSR = arcpy.Describe(destFC).spatialReference
+        cfLayers[destFC] = (outNALayer, subLayerNames, barrierMappings, routes, destSR)
+    return cfLayers[destFC]
+
+
+def solveDetours(busID, bridgeList, network, destFC, sourceNames):
+    outNALayer, subLayerNames, barrierMappings, routes, destSR = getCFLayer(network, destFC)
+
+    # Select the business (incident) and load it once for all of the bridges it crosses
+    arcpy.SelectLayerByAttribute_management("businessDetour", "NEW_SELECTION", "OBJECTID = {0}".format(int(busID)))
+    arcpy.na.AddLocations(outNALayer, subLayerNames["Incidents"], "businessDetour", '#', '#', '#', sourceNames,
+                          append="CLEAR")
+
+    detourRows = []
+    for bridgeNum in bridgeList:
+        # Select the bridge to remove and replace the Barrier left over from the previous solve
+        arcpy.SelectLayerByAttribute_management("removeBridge", "NEW_SELECTION", "BRDG_NBR = '{0}'".format(bridgeNum))
+        arcpy.na.AddLocations(outNALayer, subLayerNames["Barriers"], "removeBridge", barrierMappings, append="CLEAR",
+                              snap_to_position_along_network="SNAP")
+
+        # Only read routes when solve_succeeded is true, since the reused layer can still hold the previous pair's routes
+        routeRow = [busID, bridgeNum, None, None]
+        try:
+            solveResult = arcpy.na.Solve(outNALayer, "#", "CONTINUE")
+            if solveResult.getOutput(1) == "true":
+                with arcpy.da.SearchCursor(routes, ["Total_Length", "SHAPE@WKB"], spatial_reference=destSR) as sc:
+                    for totalLength, shape in sc:
+                        routeRow = [busID, bridgeNum, totalLength, shape]
+                        break
+        except arcpy.ExecuteError:
+            pass
+        detourRows.append(routeRow)
+    return detourRows
+
+
+def writeDetours(detours, results):
+    # Write detour times and shapes for a batch of solved business-bridge pairs to the detour table, flagging each pair
+    # as solved (including pairs with no detour, so they aren't solved again when a run is resumed)
+    busIDs = ",".join(sorted({str(int(busID)) for busID, bridgeNum in results}))
+    with arcpy.da.UpdateCursor(detours, ["Business_ID", brdgNoField, "No_Bridge_Time", "SHAPE@WKB", solvedField],
+                               "Business_ID IN ({0})".format(busIDs)) as uc:
+        for detoursRow in uc:
+            hit = results.get((detoursRow[0], detoursRow[1]))
+            if hit is not None:
+                detoursRow[2], detoursRow[3] = hit
+                detoursRow[4] = 1
+                uc.updateRow(detoursRow)
+
+
+if __name__ == "__main__":
+    # Check out the Network Analyst extension license
+    arcpy.CheckOutExtension("Network")
+
+    # Set start time for code
+    print("Starting Workflow at time: {0}".format(datetime.datetime.now().strftime("%H:%M:%S")))
+
+    # Create GDB Copy
+    print("Creating GDB Copy for Output")
+    start = datetime.datetime.now()
+    gdbCopy = os.path.splitext(os.path.basename(inputGDB))[0] + outExt + ".gdb"
+    copyGDB(inputGDB, wd + '\\' + gdbCopy)
+    print("\tFinished after {0}".format(str(datetime.datetime.now()-start)))
+
+    # Set Workspace to GDB Copy
+    arcpy.env.workspace = wd + '\\' + gdbCopy
+    arcpy.env.overwriteOutput = True
+
+    # Set valid snapping features from all features in network dataset (the same for every solve)
+    sourceNames = [[i.name, "SHAPE" if i.name in snappables else "NONE"]
+                   for i in arcpy.Describe(inNetworkDataset).sources]
+    print("Source Names:", sourceNames)
+
+    # Calculate network locations of all bridges once, so each solve loads its barrier from the location fields
+    print("Calculating Network Locations for Bridges")
+    start = datetime.datetime.now()
+    arcpy.na.CalculateLocations(bridges, inNetworkDataset)
+    print("\tFinished after {0}".format(str(datetime.datetime.now()-start)))
+
+    # Iterate through list of bridge tables
+    dests = arcpy.ListFeatureClasses(feature_dataset=destinations)
+    print(dests)
+
+    # Count number of detours to process, skipping pairs already solved by a previous run of the same GDB Copy
+    totalRows = 0
+    for dest in dests:
+        detours = "detours_{0}".format(dest)
+        if arcpy.Exists(detours) and arcpy.ListFields(detours, solvedField):
+            with arcpy.da.SearchCursor(detours, [solvedField], solvedField + " IS NULL") as sc:
+                totalRows += sum(1 for row in sc)
+        else:
+            totalRows += int(arcpy.GetCount_management("Bridges_by_Bus_{0}".format(dest)).getOutput(0))
+    print("Total Rows to Process: {0}".format(totalRows))
+
+    # Set iterating variables
+    x=0
+    startRow = datetime.datetime.now()
+
+    # Loop through bridge tables and calculate detours for each bridge-business pair
+    for dest in dests:
+        print("Initiating Workflow for Destination: {0}\tat {1}".format(dest, datetime.datetime.now().strftime("%H:%M:%S")))
+        inFacilities = destinations + "/" + dest
+
+        # Copy bridge table from traversal step and setup new detour time and solved fields, unless a previous run of
+        # the same GDB Copy already did so
+        bridgeTable = arcpy.env.workspace + '\\' + "Bridges_by_Bus_{0}".format(dest)
+        detours = "detours_{0}".format(dest)
+        newField = "No_Bridge_Time"
+        if not arcpy.Exists(detours):
+            arcpy.Copy_management(bridgeTable, arcpy.env.workspace + '\\' + detours)
+        for field, fieldType in [(newField, "DOUBLE"), (solvedField, "SHORT")]:
+            if not arcpy.ListFields(detours, field):
+                arcpy.AddField_management(detours, field, fieldType)
+
+        # Populate dictionary with bridges and the businesses that traverse them (used to determine bridge to remove),
+        # skipping pairs already solved by a previous run
+        busDict = defaultdict(list)
+        with arcpy.da.SearchCursor(detours, ["Business_ID", brdgNoField], solvedField + " IS NULL") as sc:
+            for busID, bridgeNum in sc:
+                busDict[busID].append(bridgeNum)
+
+        # Solve a Closest Facility problem for each business-bridge pair in parallel (one task per business, so each
+        # business is selected and located once), writing the detour length and route shape for each pair to the detour
+        # table in batches as businesses finish
+        results = {}
+        with ProcessPoolExecutor(max_workers=poolSize(maxWorkers), initializer=initWorker,
+                                 initargs=(arcpy.env.workspace,)) as executor:
+            futures = [executor.submit(solveDetours, detourBusID, bridgeList, inNetworkDataset, inFacilities,
+                                       sourceNames)
+                       for detourBusID, bridgeList in busDict.items()]
+            for future in as_completed(futures):
+                for detourBusID, removeBridgeNum, length, shape in future.result():
+                    results[(detourBusID, removeBridgeNum)] = (length, shape)
+                    x+=1
+                    totalRows-=1
+                endRow = datetime.datetime.now()
+
+                # Print time statistics
+                avgTime = (endRow-startRow)/x
+                print("\tCompleted:\t{0}\n\tAvg. Time per Row:{1}\n\tRemaining Rows:{2}".format(x,avgTime,totalRows))
+                print(datetime.datetime.now())
+
+                if len(results) >= writeBatchSize:
+                    writeDetours(detours, results)
+                    results = {}
+        if results:
+            writeDetours(detours, results)
+
+        # Calculate detour metrics in detours table in a single pass (detour time, TI-weighted and fully weighted)
+        detTime = "DET_TIME"
+        jobDetTime = "JOB_DET_TIME"
+        distWghtDetTime = "DISTW_JOB_DET_TIME"
+        for field in [detTime, jobDetTime, distWghtDetTime]:
+            if not arcpy.ListFields(detours, field):
+                arcpy.AddField_management(detours, field, "DOUBLE")
+        with arcpy.da.UpdateCursor(detours, [newField, "Base_Length", "Truck_Int", "Truck_Int_DW", detTime, jobDetTime,
+                                             distWghtDetTime]) as uc:
+            for noBridgeTime, baseLength, truckInt, truckIntDW, _, _, _ in uc:
+                dt = noBridgeTime - baseLength if noBridgeTime is not None and baseLength is not None else None
+                jobDT = dt * truckInt if dt is not None and truckInt is not None else None
+                distWJobDT = dt * truckIntDW if dt is not None and truckIntDW is not None else None
+                uc.updateRow([noBridgeTime, baseLength, truckInt, truckIntDW, dt, jobDT, distWJobDT])
+
+    # Merge all detour tables into single table, if selected
+    detourTables = ["detours_{0}".format(dest) for dest in dests]
+    if mergeDetours:
+        arcpy.Merge_management(detourTables, arcpy.env.workspace + '\\' + "Detours_Merged")
+
+    # Read detour metrics from all detour tables into a single array (nulls are summed as zero) and calculate summary of
+    # detour statistics by bridge
+    detFields = [detTime, jobDetTime, distWghtDetTime]
+    detourArr = numpy.concatenate([arcpy.da.TableToNumPyArray(t, [brdgNoField] + detFields,
+                                                              null_value={f: 0 for f in detFields})
+                                   for t in detourTables])
+    detSum = "DET_TIME_SUM"
+    jobDetSum = "JOB_DET_TIME_SUM"
+    distWDetTimeSum = "DISTW_JOB_DET_TIME_SUM"
+    frequencyTable(detourArr, os.path.join(arcpy.env.workspace, "Detours_by_Bridge"), brdgNoField, "FREQUENCY",
+                   {detTime: detSum, jobDetTime: jobDetSum, distWghtDetTime: distWDetTimeSum})
+
+    # Join bridge metrics from detour table to bridges, replacing any joined by a previous run of the same GDB Copy
+    oldFields = [f.name for f in arcpy.ListFields(bridges) if f.name in (detSum, jobDetSum, distWDetTimeSum)]
+    if oldFields:
+        arcpy.DeleteField_management(bridges, oldFields)
+    arcpy.JoinField_management(bridges, brdgNoField, "Detours_by_Bridge", brdgNoField, [detSum, jobDetSum, distWDetTimeSum])
+
+    # Calc and print end time.
+    endingTime = datetime.datetime.now()
+    print(endingTime)
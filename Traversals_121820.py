@@ -27,12 +27,11 @@
 import time
 import datetime, sys
 import arcpy, os
-# Check out the Network Analyst extension license
-arcpy.CheckOutExtension("Network")
-
-# Set start time for code (used to test run time)
-startingTime = datetime.datetime.now()
-print("Starting Workflow at time: {0}".format(datetime.datetime.now().strftime("%H:%M:%S")))
+import multiprocessing
+from functools import partial
+import numpy
+import pyproj
+from Common_121820 import copyGDB, frequencyTable, initWorkspace, poolSize
 
 ########################################### MODEL INPUTS & SETTINGS ####################################################
 
@@ -53,6 +52,10 @@ bridges = r"Weight_Restricted_Bridges"
 
 # Define trucking intensity field name in business data
 truckIntRaw = "Truck_Int_Raw"
+# Define field name for trucking intensity divided by number of destinations (added to business data)
+truckInt = "Truck_Int"
+# Define field name for distance-weighted trucking intensity (added to bridge tables)
+truckIntDW = "Truck_Int_DW"
 
 # Define bridge identifier field (bridge number) in bridge data
 bridgeIDField = "BRDG_NBR"
@@ -67,39 +70,49 @@ ogBridgeXField = 'X_COORD'
 ogBridgeYField = 'Y_COORD'
 
 # Select whether or not to calculate traversals for network segments (greatly increases run time)
-calcNetwork = "False"
+calcNetwork = False
 # Set variables for business to bridge distance weighting (default cutoff = 1, default power = 1)
 cutoff = '1'
 power = '1'
 
 ########################################################################################################################
 
-# Create GDB Copy in working directory
-print("Creating GDB Copy for Output")
-start = datetime.datetime.now()
-gdbCopy = os.path.splitext(os.path.basename(inputGDB))[0] + outExt + ".gdb"
-arcpy.Copy_management(inputGDB, wd + '\\' + gdbCopy)
-print("\tFinished after {0}".format(str(datetime.datetime.now() - start)))
-
-# Set Workspace to GDB Copy
-arcpy.env.workspace = wd + '\\' + gdbCopy
-print(arcpy.env.workspace)
-arcpy.env.overwriteOutput = True
-
-# Get list of border point feature classes
-dests = arcpy.ListFeatureClasses(feature_dataset=destinations)
-print("Destinations: {0}".format(dests))
-n = 1
-
-# Calculate new trucking intensity by dividing raw TI by number of routes to be generated for each business
-print("Dividing Trucking Intensity by Number of Destinations")
-truckIntDiv = len(dests)
-arcpy.AddField_management(businesses, "Truck_Int", "FLOAT")
-truckInt = "Truck_Int"
-arcpy.CalculateField_management(businesses, truckInt, '!Truck_Int_Raw!/{0}'.format(truckIntDiv), "PYTHON3")
 
-# Loop through Traversal workflow for each set of border points
-for dest in dests:
+def sumTravFields(inTable, sumFields):
+    # Replace nulls with zeroes in traversal fields and calculate each sum field as the NumPy column sum of its group of
+    # traversal fields, then write all fields back to the table in a single pass. sumFields maps each sum field name to
+    # its NumPy type and the list of fields it sums
+    oidField = arcpy.Describe(inTable).OIDFieldName
+    travFields = [f for fieldType, fields in sumFields.values() for f in fields]
+    travArr = arcpy.da.TableToNumPyArray(inTable, [oidField] + travFields, null_value=0)
+    sumArr = numpy.empty(travArr.shape, travArr.dtype.descr + [(name, fieldType)
+                                                               for name, (fieldType, fields) in sumFields.items()])
+    for name in travArr.dtype.names:
+        sumArr[name] = travArr[name]
+    for name, (fieldType, fields) in sumFields.items():
+        sumArr[name] = numpy.sum([travArr[f] for f in fields], axis=0)
+    arcpy.da.ExtendTable(inTable, oidField, sumArr, oidField, append_only=False)
+
+
+# Scratch GDB owned by this worker process; workers write their outputs here rather than to the GDB Copy, so parallel
+# workers never create feature classes or tables in the same GDB
+scratchGDB = None
+# Coordinates and trucking intensity of businesses, keyed by business ID
+busDict = {}
+
+
+def initWorker(gdbPath, scratchFolder):
+    global scratchGDB
+    initWorkspace(gdbPath)
+    scratchGDB = arcpy.CreateFileGDB_management(scratchFolder, "worker_{0}.gdb".format(os.getpid())).getOutput(0)
+
+    # Read businesses once per worker; trucking intensity is calculated before the workers start
+    with arcpy.da.SearchCursor(businesses, ["OID@", ogBusXField, ogBusYField, truckInt]) as sc:
+        for row in sc:
+            busDict[row[0]] = row[1:]
+
+
+def processDest(dest, sourceNames):
     # Set local variables
     outNALayerName = dest + "_" + "CF"
     impedanceAttribute = "Length"
@@ -109,7 +122,11 @@ for dest in dests:
     # Create a new closest facility analysis layer.
     print("Initiating Workflow for Destination: {0}\tat {1}".format(dest, datetime.datetime.now().strftime("%H:%M:%S")))
     print("\tStarting Workflow at time: {0}".format(datetime.datetime.now().strftime("%H:%M:%S")))
-    outNALayer = arcpy.na.MakeClosestFacilityLayer(inNetworkDataset, outNALayerName, impedanceAttribute)
+    # Store the layer's data in the memory workspace so parallel workers don't share ClosestFacility{n} datasets in the
+    # GDB
+    networkPath = os.path.join(arcpy.env.workspace, inNetworkDataset)
+    with arcpy.EnvManager(workspace="memory"):
+        outNALayer = arcpy.na.MakeClosestFacilityLayer(networkPath, outNALayerName, impedanceAttribute)
 
     # Get the layer object from the result object. The closest facility layer can now be referenced using the layer
     # object.
@@ -122,15 +139,6 @@ for dest in dests:
     facilitiesLayerName = subLayerNames["Facilities"]
     incidentsLayerName = subLayerNames["Incidents"]
 
-, thou    descNet = arcpy.Describe(inNetworkDataset)
-    sourceNames = [[i.name] for i in descNet.sources]
-    for i in sourceNames:
-        if i[0] in snappables:
-            i.append("SHAPE")
-        else:
-            i.append("NONE")
-    print("Source Names:", sourceNames)
-
     # Load border point features as facilities and ensure that they are not located on restricted portions of the
     # network. Use default field mappings and search tolerance
     arcpy.na.AddLocations(outNALayer, facilitiesLayerName, inFacilities)
@@ -156,26 +164,78 @@ for dest in dests:
     # Print status of Hierarchy use to confirm correct setting
     print("Hierarchy:" + desc.useHierarchy)
 
-    # Solve and copy traversed source features
-    arcpy.CopyTraversedSourceFeatures_na(outNALayer, arcpy.env.workspace, destEdges,
-                                         dest + "_" + "TravJunc", dest + "_" + "TravTurn")
+    # Solve and copy traversed source features; traversed features are only used for network traversals, so otherwise
+    # just solve
+    if calcNetwork:
+        arcpy.CopyTraversedSourceFeatures_na(outNALayer, scratchGDB, destEdges,
+                                             dest + "_" + "TravJunc", dest + "_" + "TravTurn")
+    else:
+        arcpy.na.Solve(outNALayer)
     print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
 
-    # Spatially Join bridges to route features using one-to-many join
-    print("\tJoining Bridge Traversals to Routes")
+    # Copy routes to this worker's scratch GDB so they can be spatially joined to bridges in chunks by other workers
+    print("\tCopying Routes")
     start = datetime.datetime.now()
-    routes = "ClosestFacility{0}/CFRoutes{0}".format(n)
-    routesBridgesSJ = "routesBridgesSJ_" + dest
-    arcpy.SpatialJoin_analysis(routes, bridges, routesBridgesSJ, "JOIN_ONE_TO_MANY", "#", "#",
-                               "INTERSECT", "5 Feet")
+    routes = outNALayer.listLayers(subLayerNames["CFRoutes"])[0]
+    routesFC = os.path.join(scratchGDB, dest + "_Routes")
+    arcpy.CopyFeatures_management(routes, routesFC)
     print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
 
-    # Create Bridge Table and set up to store unique business-bridge combinations with all necessary fields
-    print("\tCreating Bridge Feature Class")
+    # Calculate network traversals, if dummy variable is set to True
+    destFreq = None
+    if calcNetwork:
+        destEdges = os.path.join(scratchGDB, destEdges)
+
+        # Write job counts from businesses and the join field (source name and source OID) to traversed features in a
+        # single pass, looking up the business served by each route and its trucking intensity from dictionaries
+        print("\tJoining Job Counts to Traversed Edges and Calculating Join Field")
+        start = datetime.datetime.now()
+        routeDict = {}
+        with arcpy.da.SearchCursor(routes, ["OID@", "IncidentID"]) as sc:
+            for row in sc:
+                routeDict[row[0]] = row[1]
+        arcpy.AddField_management(destEdges, truckInt, "FLOAT")
+        arcpy.AddField_management(destEdges, "Network_Sect_Concat", "TEXT")
+        with arcpy.da.UpdateCursor(destEdges, ["RouteID", "SourceName", "SourceOID", truckInt,
+                                               "Network_Sect_Concat"]) as uc:
+            for row in uc:
+                busRow = busDict.get(routeDict.get(row[0]))
+                uc.updateRow(row[:3] + [busRow[2] if busRow is not None else None, "{0}{1}".format(row[1], row[2])])
+        print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
+
+        # Calculate the frequency of SourceOID in the traversed edges
+        print("\tGenerating Frequency Table")
+        start = datetime.datetime.now()
+        destFreq = os.path.join(scratchGDB, dest + "_" + "edgeFreq")
+        netBusFreqField = dest + "_" + "TRAV_BUS"
+        netJobFreqField = dest + "_" + "TRAV_JOB"
+        edgeArr = arcpy.da.TableToNumPyArray(destEdges, ["Network_Sect_Concat", truckInt], null_value={truckInt: 0})
+        frequencyTable(edgeArr, destFreq, "Network_Sect_Concat", netBusFreqField, {truckInt: netJobFreqField})
+        print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
+
+    # Delete the closest facility layer from memory so this worker doesn't hold the solve during the spatial join
+    arcpy.Delete_management(outNALayer)
+
+    return dest, routesFC, destFreq
+
+
+def joinRoutesChunk(dest, routesFC, chunk, chunks):
+    # Spatially Join bridges to one chunk of a destination's routes (every route whose OID MOD chunks equals chunk)
+    # using one-to-many join
+    print("\tJoining Bridge Traversals to Routes for Destination: {0} (Chunk {1})".format(dest, chunk))
     start = datetime.datetime.now()
-    arcpy.CreateFeatureclass_management(arcpy.env.workspace, "Bridges_by_Bus_{0}".format(dest), "POLYLINE", '#', '#',
-                                        '#', arcpy.Describe(dest).spatialReference)
-    bridgeTable = arcpy.env.workspace + r'/' + "Bridges_by_Bus_{0}".format(dest)
+    oidField = arcpy.Describe(routesFC).OIDFieldName
+    routesLayer = arcpy.MakeFeatureLayer_management(routesFC, "routes_{0}_{1}".format(dest, chunk),
+                                                    "MOD({0}, {1}) = {2}".format(oidField, chunks, chunk))
+    routesBridgesSJ = "memory\\routesBridgesSJ_{0}_{1}".format(dest, chunk)
+    arcpy.SpatialJoin_analysis(routesLayer, bridges, routesBridgesSJ, "JOIN_ONE_TO_MANY", "#", "#",
+                               "INTERSECT", "5 Feet")
+
+    # Create Bridge Table for the chunk in this worker's scratch GDB and set up to store unique business-bridge
+    # combinations with all necessary fields
+    destSR = arcpy.Describe(dest).spatialReference
+    bridgeTable = arcpy.CreateFeatureclass_management(scratchGDB, "Bridges_by_Bus_{0}_{1}".format(dest, chunk),
+                                                      "POLYLINE", '#', '#', '#', destSR).getOutput(0)
     busIDField = "Business_ID"
     arcpy.AddField_management(bridgeTable, busIDField, "LONG")
     arcpy.AddField_management(bridgeTable, bridgeIDField, "TEXT")
@@ -184,193 +244,187 @@ for dest in dests:
     arcpy.AddField_management(bridgeTable, bridgeX, "DOUBLE")
     bridgeY = "Bridge_Y"
     arcpy.AddField_management(bridgeTable, bridgeY, "DOUBLE")
-
-    # Write routes with non-null bridge crossings to Bridge Table using cursors
-    try:
-        sc = arcpy.da.SearchCursor(routesBridgesSJ, ["IncidentID", bridgeIDField, ogBridgeXField, ogBridgeYField,
-                                                     "Total_Length", 'SHAPE@'], "BRDG_NBR IS NOT NULL")
-        for row in sc:
-            try:
-                ic = arcpy.da.InsertCursor(bridgeTable, [busIDField, bridgeIDField, bridgeX, bridgeY,
-                                                         "Base_Length", 'SHAPE@'])
-                ic.insertRow(row)
-                del ic
-            except:
-                print("ic failure")
-        del sc
-    except:
-        print("sc failure")
-
-    # Add coordinates of businesses and trucking intensity to bridge table using field join
-    arcpy.JoinField_management(bridgeTable, busIDField, businesses, "OBJECTID", [ogBusXField, ogBusYField, truckInt])
     busX = "Business_X"
-    arcpy.AlterField_management(bridgeTable, ogBusXField, busX, busX)
-    busY = "Business_Y"income
-    arcpy.AlterField_management(bridgeTable, ogBusYField, busY, busY)
-    print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
-
-    # Calculate straight line distance from business to bridge in map units
-    xyFeatureClass = "bus_to_bridge_dist_{0}".format(dest)
-    arcpy.XYToLine_management(bridgeTable, xyFeatureClass, busX, busY, bridgeX, bridgeY, "GEODESIC")
-    distMUField = "BUS_TO_BRIDGE_MU"
-    arcpy.AddField_management(xyFeatureClass, distMUField, "DOUBLE")
-    arcpy.CalculateField_management(xyFeatureClass, distMUField, '!Shape_Length!', "PYTHON3")
-
-    # Join straight line distance back to bridges by business table and convert to miles
-    arcpy.JoinField_management(bridgeTable, "OBJECTID", xyFeatureClass, "OID", [distMUField])
+    arcpy.AddField_management(bridgeTable, busX, "DOUBLE")
+    busY = "Business_Y"
+    arcpy.AddField_management(bridgeTable, busY, "DOUBLE")
+    arcpy.AddField_management(bridgeTable, truckInt, "FLOAT")
     distMiField = "BUS_TO_BRIDGE_MI"
     arcpy.AddField_management(bridgeTable, distMiField, "DOUBLE")
-    arcpy.CalculateField_management(bridgeTable, distMiField, '!{0}!/5280'.format(distMUField), "PYTHON3")
-
-    # Calculate unique distance-weighted trucking intensity value for each business-bridge pair
-    truckIntDW = "Truck_Int_DW"
     arcpy.AddField_management(bridgeTable, truckIntDW, "DOUBLE")
-    arcpy.CalculateField_management(bridgeTable, truckIntDW, '(!Truck_Int!*{0})/(!BUS_TO_BRIDGE_MI!**({1}))'.format(cutoff, power), "PYTHON3")
-    
-    # Calculate network traversals, if dummy variable is set to True
-    if calcNetwork == "True":
-        # Join job counts from businesses to routes
-        print("\tJoining Job Counts to Routes")
-        start = datetime.datetime.now()
-        routes = "ClosestFacility{0}/CFRoutes{0}".format(n)
-        arcpy.JoinField_management(routes, "IncidentID", businesses, "OBJECTID", truckInt)
-        print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
 
-        # Join job counts from routes to traversed features
-        print("\tJoining Job Counts to Traversed Edges")
-        start = datetime.datetime.now()
-        arcpy.JoinField_management(destEdges, "RouteID", routes, "ObjectID", truckInt)
-        print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
-
-        # Calculate Join Field in Traversed Edges
-        print("\tCalculating Join Field in Traversed Edges")
-        start = datetime.datetime.now()
-        arcpy.AddField_management(destEdges, "Network_Sect_Concat", "TEXT")
-        arcpy.CalculateField_management(destEdges, "Network_Sect_Concat", '!SourceName! + str(!SourceOID!)', "PYTHON3")
-        print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
-
-        # Calculate the frequency of SourceOID in the traversed edges
-        print("\tGenerating Frequency Table")
-        start = datetime.datetime.now()
-        destFreq = dest + "_" + "edgeFreq"
-        arcpy.analysis.Frequency(destEdges, destFreq, "Network_Sect_Concat", truckInt)
-        print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
+    # Read routes with non-null bridge crossings (projected to the destination's spatial reference), adding the
+    # coordinates of businesses and trucking intensity from the business dictionary
+    with arcpy.da.SearchCursor(routesBridgesSJ, ["IncidentID", bridgeIDField, ogBridgeXField, ogBridgeYField,
+                                                 "Total_Length", 'SHAPE@'], "BRDG_NBR IS NOT NULL", destSR) as sc:
+        bridgeRows = [row + busDict.get(row[0], (None, None, None)) for row in sc]
+    arcpy.Delete_management(routesBridgesSJ)
+    arcpy.Delete_management(routesLayer)
+
+    # Calculate geodesic distance from business to bridge in miles and the unique distance-weighted trucking intensity
+    # value for each business-bridge pair (null where either can't be calculated)
+    bridgeXArr, bridgeYArr, busXArr, busYArr, truckIntArr = [numpy.array([row[i] for row in bridgeRows], dtype=float)
+                                                             for i in (2, 3, 6, 7, 8)]
+    distMiArr = pyproj.Geod(ellps="WGS84").inv(busXArr, busYArr, bridgeXArr, bridgeYArr)[2] / 1609.344
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        truckIntDWArr = (truckIntArr * float(cutoff)) / (distMiArr ** float(power))
+    distMiArr = numpy.where(numpy.isfinite(distMiArr), distMiArr, None)
+    truckIntDWArr = numpy.where(numpy.isfinite(truckIntDWArr), truckIntDWArr, None)
+
+    # Write business-bridge rows to Bridge Table using a single cursor
+    with arcpy.da.InsertCursor(bridgeTable, [busIDField, bridgeIDField, bridgeX, bridgeY, "Base_Length", 'SHAPE@',
+                                             busX, busY, truckInt, distMiField, truckIntDW]) as ic:
+        for row, distMi, truckIntDWValue in zip(bridgeRows, distMiArr, truckIntDWArr):
+            ic.insertRow(row + (distMi, truckIntDWValue))
+    print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
 
-        # Rename Fields
-        netBusFreqField = dest + "_" + "TRAV_BUS"
-        print("\tRenaming Frequency Field")
-        arcpy.AlterField_management(destFreq, "FREQUENCY", netBusFreqField, netBusFreqField)
+    return dest, bridgeTable
 
-        netJobFreqField = dest + "_" + "TRAV_JOB"
-        print("\tRenaming Trucking Job Field")
-        arcpy.AlterField_management(destFreq, truckInt, netJobFreqField, netJobFreqField)
 
-    # Calculate frequencies for bridges
-    print("Calculating Frequencies for Bridges")
-    freqTable = "{0}_FreqTable".format(dest)
-    arcpy.Frequency_analysis(bridgeTable, freqTable, bridgeIDField, [truckInt, truckIntDW])
+if __name__ == "__main__":
+    # Check out the Network Analyst extension license
+    arcpy.CheckOutExtension("Network")
 
-    freqField = dest + "_" + "TRAV_BUS"
-    arcpy.AlterField_management(freqTable, "FREQUENCY", freqField, freqField)
+    # Set start time for code (used to test run time)
+    startingTime = datetime.datetime.now()
+    print("Starting Workflow at time: {0}".format(datetime.datetime.now().strftime("%H:%M:%S")))
 
-    jobFreqField = dest + "_" + "TRAV_JOB"
-    arcpy.AlterField_management(freqTable, truckInt, jobFreqField, jobFreqField)
+    # Create GDB Copy in working directory
+    print("Creating GDB Copy for Output")
+    start = datetime.datetime.now()
+    gdbCopy = os.path.splitext(os.path.basename(inputGDB))[0] + outExt + ".gdb"
+    copyGDB(inputGDB, wd + '\\' + gdbCopy)
+    print("\tFinished after {0}".format(str(datetime.datetime.now() - start)))
 
-    jobDWFreqField = dest + "_" + "TRAV_JOB_DISTW"
-    arcpy.AlterField_management(freqTable, truckIntDW, jobDWFreqField, jobDWFreqField)
+    # Set Workspace to GDB Copy
+    arcpy.env.workspace = wd + '\\' + gdbCopy
+    print(arcpy.env.workspace)
+    arcpy.env.scratchWorkspace = "memory"
+    arcpy.env.overwriteOutput = True
 
-    arcpy.JoinField_management(bridges, bridgeIDField, freqTable, bridgeIDField,
-                               [freqField, jobFreqField, jobDWFreqField])
-    print("\tFinished after {0}".format(str(datetime.datetime.now() - start)))
+    # Get list of border point feature classes
+    dests = arcpy.ListFeatureClasses(feature_dataset=destinations)
+    print("Destinations: {0}".format(dests))
 
-    # Iterate n
-    n += 1
-
-# Replace nulls with zeroes
-print("Replacing Bridge Traversal Null Values with Zeros")
-start = datetime.datetime.now()
-bridgeFList = arcpy.ListFields(bridges, "*_TRAV_*")
-codeBlock = """
-def zeroNulls(value):
-    if value == None:
-        return 0
-    else:
-        return value"""
-for field in bridgeFList:
-    expression = "zeroNulls(!{0}!)".format(field.name)
-    arcpy.CalculateField_management(bridges, field.name, expression, "PYTHON", codeBlock)
-print("Finished after {0}".format(str(datetime.datetime.now() - start)))
-
-# Calculate sum fields for bridges (traversals, TI-weighted traversals, fully weighted traversals)
-print("Calculating Sum Fields for Bridges")
-start = datetime.datetime.now()
-arcpy.AddField_management(bridges, "BUS_TRAV_SUM", "LONG")
-fieldList = ["!{0}!".format(f.name) for f in arcpy.ListFields(bridges, "*_TRAV_BUS*")]
-sumExp = "+".join(fieldList)
-arcpy.CalculateField_management(bridges, "BUS_TRAV_SUM", sumExp, "PYTHON3")
-
-arcpy.AddField_management(bridges, "JOB_TRAV_SUM", "DOUBLE")
-fieldList = ["!{0}!".format(f.name) for f in arcpy.ListFields(bridges, "*_TRAV_JOB")]
-sumExp = "+".join(fieldList)
-arcpy.CalculateField_management(bridges, "JOB_TRAV_SUM", sumExp, "PYTHON3")
-print("\tFinished after {0}".format(str(datetime.datetime.now() - start)))
-print("Joining Frequencies to Bridges")
-start = datetime.datetime.now()
-
-arcpy.AddField_management(bridges, "DISTW_JOB_TRAV_SUM", "DOUBLE")
-fieldList = ["!{0}!".format(f.name) for f in arcpy.ListFields(bridges, "*_TRAV_JOB_DISTW")]
-sumExp = "+".join(fieldList)
-arcpy.CalculateField_management(bridges, "DISTW_JOB_TRAV_SUM", sumExp, "PYTHON3")
-print("\tFinished after {0}".format(str(datetime.datetime.now() - start)))
-
-# Determine process end time and duration
-endingTime = datetime.datetime.now()
-print("Process Complete. Total Duration for {0} destinations: {1}".format(len(dests), str(endingTime - startingTime)))
-
-# Calculate final network sums and metrics, if dummy variable is set to True.
-if calcNetwork == "True":
-    # Join to Network Table
-    print("\tJoining Frequency to Network")
-    start = datetime.datetime.now()
-    for destClass in arcpy.ListTables("*_edgeFreq"):
-        inTable = flatNetwork
-        inField = "Network_Sect_Name"
-        joinTable = destClass
-        joinField = "Network_Sect_Concat"
-        fields = [f.name for f in arcpy.ListFields(joinTable, "*TRAV*")]
-        arcpy.JoinField_management(inTable, inField, joinTable, joinField, fields)
-        print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
+    # Set valid snapping features from all features in network dataset (the same for every destination)
+    sourceNames = [[i.name, "SHAPE" if i.name in snappables else "NONE"]
+                   for i in arcpy.Describe(inNetworkDataset).sources]
+    print("Source Names:", sourceNames)
 
-    # Export to new feature class
-    print("Exporting Network to New Feature Class")
+    # Calculate new trucking intensity by dividing raw TI by number of routes to be generated for each business
+    print("Dividing Trucking Intensity by Number of Destinations")
+    truckIntDiv = len(dests)
+    if not arcpy.ListFields(businesses, truckInt):
+        arcpy.AddField_management(businesses, truckInt, "FLOAT")
+    with arcpy.da.UpdateCursor(businesses, [truckIntRaw, truckInt]) as uc:
+        for row in uc:
+            uc.updateRow([row[0], row[0] / truckIntDiv if row[0] is not None else None])
+
+    # Split each destination's routes into enough chunks to keep every worker busy during the spatial join, and start
+    # no more workers than there are chunks (every worker reads businesses and creates a scratch GDB)
+    joinChunks = max(1, poolSize() // len(dests))
+    workers = poolSize(len(dests) * joinChunks)
+
+    # Create folder for the scratch GDB of each worker process, replacing any left by an interrupted run
+    scratchFolder = wd + '\\' + os.path.splitext(gdbCopy)[0] + "_scratch"
+    if arcpy.Exists(scratchFolder):
+        arcpy.Delete_management(scratchFolder)
+    os.makedirs(scratchFolder)
+
+    # Run Traversal workflow for each set of border points in parallel; each worker writes only to its own scratch GDB.
+    # Routes are solved per destination, then spatially joined to bridges in chunks across all workers, each chunk
+    # writing its own Bridge Table
+    with multiprocessing.Pool(processes=workers, initializer=initWorker,
+                              initargs=(arcpy.env.workspace, scratchFolder)) as pool:
+        destOutputs = pool.map(partial(processDest, sourceNames=sourceNames), dests)
+        chunkBridgeTables = {dest: [] for dest in dests}
+        for dest, chunkBridgeTable in pool.starmap(joinRoutesChunk, [(dest, routesFC, chunk, joinChunks)
+                                                                     for dest, routesFC, destFreq in destOutputs
+                                                                     for chunk in range(joinChunks)]):
+            chunkBridgeTables[dest].append(chunkBridgeTable)
+
+    # Merge the chunk Bridge Tables for each destination and copy edge frequency tables from the scratch GDBs to the GDB
+    # Copy, calculate frequencies for bridges, then delete the scratch GDBs (including the copied routes), now that only
+    # this process writes to the GDB Copy
+    print("Merging Bridge Tables and Calculating Frequencies for Bridges")
     start = datetime.datetime.now()
-    arcpy.FeatureClassToFeatureClass_conversion(flatNetwork, arcpy.env.workspace, "Network_Joined")
-    print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
+    freqTables = []
+    for dest in dests:
+        bridgeTable = os.path.join(arcpy.env.workspace, "Bridges_by_Bus_{0}".format(dest))
+        arcpy.Merge_management(chunkBridgeTables[dest], bridgeTable)
+        freqTable = "{0}_FreqTable".format(dest)
+        freqField = dest + "_" + "TRAV_BUS"
+        jobFreqField = dest + "_" + "TRAV_JOB"
+        jobDWFreqField = dest + "_" + "TRAV_JOB_DISTW"
+        bridgeArr = arcpy.da.TableToNumPyArray(bridgeTable, [bridgeIDField, truckInt, truckIntDW],
+                                               null_value={truckInt: 0, truckIntDW: 0})
+        frequencyTable(bridgeArr, os.path.join(arcpy.env.workspace, freqTable), bridgeIDField, freqField,
+                       {truckInt: jobFreqField, truckIntDW: jobDWFreqField})
+        freqTables.append((dest, freqTable))
+    for dest, routesFC, destFreq in destOutputs:
+        if destFreq is not None:
+            arcpy.Copy_management(destFreq, os.path.join(arcpy.env.workspace, dest + "_" + "edgeFreq"))
+    arcpy.Delete_management(scratchFolder)
+    print("\tFinished after {0}".format(str(datetime.datetime.now() - start)))
 
-    # Replace nulls with zeroes
-    print("Replacing Network Null Values with Zeros")
+    # Join bridge frequencies for each destination to bridges
+    print("Joining Frequencies to Bridges")
     start = datetime.datetime.now()
-    networkFList = arcpy.ListFields("Network_Joined", "*TRAV*")
-    codeBlock = """def zeroNulls(value):
-        if value == None:
-            return 0
-        else:
-            return value"""
-    for field in networkFList:
-        expression = "zeroNulls(!{0}!)".format(field.name)
-        arcpy.CalculateField_management("Network_Joined", field.name, expression, "PYTHON", codeBlock)
+    for dest, freqTable in freqTables:
+        freqField = dest + "_" + "TRAV_BUS"
+        jobFreqField = dest + "_" + "TRAV_JOB"
+        jobDWFreqField = dest + "_" + "TRAV_JOB_DISTW"
+        # Replace fields joined by a previous run on a reused GDB copy rather than duplicating them
+        oldFields = [f.name for f in arcpy.ListFields(bridges) if f.name in (freqField, jobFreqField, jobDWFreqField)]
+        if oldFields:
+            arcpy.DeleteField_management(bridges, oldFields)
+        arcpy.JoinField_management(bridges, bridgeIDField, freqTable, bridgeIDField,
+                                   [freqField, jobFreqField, jobDWFreqField])
     print("\tFinished after {0}".format(str(datetime.datetime.now() - start)))
 
-    # Calculate Sum Fields for Network
-    print("Calculating Sum Fields for Network")
+    # Replace nulls with zeroes and calculate sum fields for bridges (traversals, TI-weighted traversals, fully weighted
+    # traversals) using NumPy column sums, then write all fields back to bridges in a single pass
+    print("Replacing Bridge Traversal Null Values with Zeros and Calculating Sum Fields for Bridges")
     start = datetime.datetime.now()
-    arcpy.AddField_management("Network_Joined", "BUS_TRAV_SUM", "LONG")
-    fieldList = ["!{0}!".format(f.name) for f in arcpy.ListFields("Network_Joined", "*TRAV_BUS*")]
-    sumExp = "+".join(fieldList)
-    arcpy.CalculateField_management("Network_Joined", "BUS_TRAV_SUM", sumExp, "PYTHON3")
-
-    arcpy.AddField_management("Network_Joined", "JOB_TRAV_SUM", "DOUBLE")
-    fieldList = ["!{0}!".format(f.name) for f in arcpy.ListFields("Network_Joined", "*TRAV_JOB*")]
-    sumExp = "+".join(fieldList)
-    arcpy.CalculateField_management("Network_Joined", "JOB_TRAV_SUM", sumExp, "PYTHON3")
+    sumTravFields(bridges, {
+        "BUS_TRAV_SUM": (numpy.int32, [f.name for f in arcpy.ListFields(bridges, "*_TRAV_BUS*")]),
+        "JOB_TRAV_SUM": (numpy.float64, [f.name for f in arcpy.ListFields(bridges, "*_TRAV_JOB")]),
+        "DISTW_JOB_TRAV_SUM": (numpy.float64, [f.name for f in arcpy.ListFields(bridges, "*_TRAV_JOB_DISTW")])})
     print("\tFinished after {0}".format(str(datetime.datetime.now() - start)))
+
+    # Determine process end time and duration
+    endingTime = datetime.datetime.now()
+    print("Process Complete. Total Duration for {0} destinations: {1}".format(len(dests),
+                                                                             str(endingTime - startingTime)))
+
+    # Calculate final network sums and metrics, if dummy variable is set to True.
+    if calcNetwork:
+        # Join to Network Table
+        print("\tJoining Frequency to Network")
+        start = datetime.datetime.now()
+        for destClass in arcpy.ListTables("*_edgeFreq"):
+            inTable = flatNetwork
+            inField = "Network_Sect_Name"
+            joinTable = destClass
+            joinField = "Network_Sect_Concat"
+            fields = [f.name for f in arcpy.ListFields(joinTable, "*TRAV*")]
+            oldFields = [f.name for f in arcpy.ListFields(inTable) if f.name in fields]
+            if oldFields:
+                arcpy.DeleteField_management(inTable, oldFields)
+            arcpy.JoinField_management(inTable, inField, joinTable, joinField, fields)
+            print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
+
+        # Export to new feature class
+        print("Exporting Network to New Feature Class")
+        start = datetime.datetime.now()
+        arcpy.FeatureClassToFeatureClass_conversion(flatNetwork, arcpy.env.workspace, "Network_Joined")
+        print("\t\tFinished after {0}".format(str(datetime.datetime.now() - start)))
+
+        # Replace nulls with zeroes and calculate sum fields for network using NumPy column sums, then write all fields
+        # back to the network in a single pass
+        print("Replacing Network Null Values with Zeros and Calculating Sum Fields for Network")
+        start = datetime.datetime.now()
+        sumTravFields("Network_Joined", {
+            "BUS_TRAV_SUM": (numpy.int32, [f.name for f in arcpy.ListFields("Network_Joined", "*TRAV_BUS*")]),
+            "JOB_TRAV_SUM": (numpy.float64, [f.name for f in arcpy.ListFields("Network_Joined", "*TRAV_JOB*")])})
+        print("\tFinished after {0}".format(str(datetime.datetime.now() - start)))